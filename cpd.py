@@ -34,10 +34,23 @@ CPD is a small Python module which generates partial dependence graphics and
 tables for models.
 """
 
+import asyncio
+import collections
+import concurrent.futures
+import copy
 import csv
+import hashlib
+import http.server
+import io
+import itertools
+import json
+import pickle
+import sys
+import threading
 import numpy as np
 import pandas as pd
-from sklearn.inspection import partial_dependence
+from scipy import sparse
+from scipy.stats.mstats import mquantiles
 import matplotlib.pyplot as plt
 import matplotlib.tri as tri
 
@@ -56,11 +69,615 @@ bibtex = """
 }
 """
 
+# Largest number of perturbed rows handed to the model in a single call
+_BATCH_ROWS = 2**16
+
+def _search_features(columns, feature_key):
+    return [x for x in columns if x.startswith(feature_key)]
+
+def _is_table(data):
+    # whether data is an Arrow table (or record batch) or a Polars data frame
+    return type(data).__module__.split('.')[0] in ('pyarrow', 'polars')
+
+def _table_columns(data):
+    # Names and NumPy arrays of the columns of an Arrow table (or record
+    # batch) or a Polars data frame; None for any other kind of data. The
+    # arrays of numeric columns stored in a single chunk without missing
+    # values are zero-copy views of the table's buffers.
+    module = type(data).__module__.split('.')[0]
+    if module == 'pyarrow':
+        return list(data.column_names), [c.to_numpy(zero_copy_only=False) for c in data.columns]
+    if module == 'polars':
+        return list(data.columns), [s.to_numpy() for s in data.get_columns()]
+    return None
+
+def _background(data, feature_names=None):
+    # background data as a float matrix (a CSR matrix, for sparse data) plus
+    # the names of its columns, which must be given for sparse data
+    if sparse.issparse(data):
+        if feature_names is None or len(feature_names) != data.shape[1]:
+            raise ValueError("Sparse data requires a feature_names list with one name per column")
+        return sparse.csr_matrix(data, dtype=float), list(feature_names)
+    table = _table_columns(data)
+    if table is not None:
+        # Arrow and Polars data are read column by column, straight into
+        # the matrix, without an intermediate pandas copy
+        names, columns = table
+        X = np.empty((len(columns[0]) if columns else 0, len(columns)), order='F')
+        for j, c in enumerate(columns):
+            X[:,j] = c
+        return X, names
+    return data.to_numpy(dtype=float), list(data.columns)
+
+def _column(X, j):
+    # values of the j-th column of the background data, as a dense vector
+    if sparse.issparse(X):
+        return X[:,j].toarray().ravel()
+    return X[:,j]
+
+def _predict(model, X, columns):
+    # model output as a (rows, outputs) matrix; as in scikit-learn's partial
+    # dependence, classifiers are evaluated through predict_proba, keeping
+    # only the positive class of binary problems
+    if not sparse.issparse(X) and not isinstance(X, pd.DataFrame):
+        X = pd.DataFrame(X, columns=columns)
+    if hasattr(model, 'predict_proba'):
+        p = np.asarray(model.predict_proba(X), dtype=float)
+        if p.shape[1] == 2:
+            p = p[:,1:]
+    else:
+        p = np.asarray(model.predict(X), dtype=float)
+    return p.reshape(X.shape[0], -1)
+
+def _plain(v):
+    # v with NumPy arrays and scalars turned into plain Python values
+    if isinstance(v, (list, tuple, np.ndarray)):
+        return [_plain(x) for x in v]
+    if isinstance(v, np.generic):
+        return v.item()
+    return v
+
+def _output_names(model, n_outputs):
+    # names of the outputs of a model: its classes, when they match
+    # the outputs of _predict, otherwise their positions
+    classes = np.asarray(getattr(model, 'classes_', [])).tolist()
+    if len(classes) == n_outputs:
+        return classes
+    if len(classes) == 2 and n_outputs == 1:
+        return classes[1:]
+    return list(range(n_outputs))
+
+class _Settings():
+    # The settings of a block given as the Cartesian product of the rows of
+    # some matrices (e.g. the levels of two one-hot groups, or the grids of
+    # two real features), the rows of the last one varying fastest. Only the
+    # rows taken (settings[s:e]) are built, so that the product of large
+    # groups is never held in memory as a whole.
+    def __init__(self, *factors):
+        self.factors = [np.asarray(f, dtype=float).reshape(len(f), -1) for f in factors]
+        self.nbytes = sum([f.nbytes for f in self.factors])
+    def __len__(self):
+        return int(np.prod([len(f) for f in self.factors]))
+    def __getitem__(self, rows):
+        pos = np.unravel_index(np.arange(*rows.indices(len(self))), [len(f) for f in self.factors])
+        return np.hstack([f[p] for f, p in zip(self.factors, pos)])
+
+def _factors(settings):
+    # the matrices of which the settings of a block are the product
+    return settings.factors if isinstance(settings, _Settings) else [np.asarray(settings, dtype=float)]
+
+def _batches(blocks, nrows, batch_rows):
+    # Split the perturbations of all blocks into model calls of about
+    # batch_rows rows. Each call is a (settings, first, last) tuple: settings
+    # is a list of (block, first, last) settings, which are applied to the
+    # rows first:last of the background. When the background has more than
+    # batch_rows rows, each call takes a single setting and part of the rows.
+    if nrows > batch_rows:
+        for b, (idx, settings) in enumerate(blocks):
+            for s in range(len(settings)):
+                for r in range(0, nrows, batch_rows):
+                    yield [(b, s, s+1)], r, min(nrows, r+batch_rows)
+        return
+    per_call = max(1, batch_rows // max(1, nrows))
+    call, size = [], 0
+    for b, (idx, settings) in enumerate(blocks):
+        s = 0
+        while s < len(settings):
+            take = min(per_call - size, len(settings) - s)
+            call.append((b, s, s+take))
+            size += take
+            s += take
+            if size == per_call:
+                yield call, 0, nrows
+                call, size = [], 0
+    if call:
+        yield call, 0, nrows
+
+def _perturbed(X, blocks, call, first, last, rest):
+    # the rows first:last of X, perturbed by each of the settings of a call
+    if sparse.issparse(X):
+        return _sparse_batch(X, blocks, call, first, last, rest)
+    n = last - first
+    batch = np.tile(X[first:last], (sum([e-s for b,s,e in call]),1))
+    pos = 0
+    for b, s, e in call:
+        idx, settings = blocks[b]
+        batch[pos*n:(pos+e-s)*n, idx] = np.repeat(settings[s:e], n, axis=0)
+        pos += e-s
+    return batch
+
+def _reduce(W, call, first, last, p):
+    # weighted sums of the per-row predictions p of a call, as a (averages,
+    # settings, outputs) array
+    total = sum([e-s for b,s,e in call])
+    return np.einsum('snk,rn->rsk', p.reshape(total, last-first, -1), W[:,first:last])
+
+def _accumulate(out, blocks, W, call, r):
+    # add the reduced predictions r of a call to the results of each block
+    pos = 0
+    for b, s, e in call:
+        if out[b] is None:
+            out[b] = np.zeros((len(W), len(blocks[b][1]), r.shape[2]))
+        out[b][:,s:e] += r[:,pos:pos+e-s]
+        pos += e-s
+
+def _evaluate(model, X, columns, blocks, weights=None, max_memory=None, usage=None):
+    """
+    Average model response over the background data X for a set of
+    perturbations. blocks is a list of (idx, settings) pairs: for every row
+    of settings, the columns idx of all background rows are overwritten with
+    that row. Perturbations from several blocks are predicted together, in
+    calls of about _BATCH_ROWS rows (or the batch_size of an Async_Model),
+    fewer if needed to keep the memory taken within max_memory bytes.
+    Returns one (len(settings), outputs) array per block.
+
+    weights may be a (averages, rows) matrix, each row of which gives the
+    weights of the background rows in one average. The per-row predictions of
+    each model call are then reduced by all those averages at once, and the
+    arrays returned have the shape (averages, len(settings), outputs).
+
+    If usage (a dict) is given, usage['peak'] is set to the largest number of
+    bytes held at once by the arrays of the evaluation.
+    """
+    n = X.shape[0]
+    W = np.full((1,n), 1.0) if weights is None else np.atleast_2d(weights)
+    W = W / W.sum(axis=1, keepdims=True)
+    rows = _batch_rows(model, X, blocks, W, max_memory)
+    usage = dict() if usage is None else usage
+    usage['peak'] = 0
+    out = [None]*len(blocks)
+    fixed = _nbytes(W) + sum([_nbytes(settings) for idx, settings in blocks])
+    if isinstance(model, Async_Model):
+        _run_async(model._evaluate(X, columns, blocks, W, rows, out, usage))
+    else:
+        rest = dict()
+        for call, first, last in _batches(blocks, n, rows):
+            batch = _perturbed(X, blocks, call, first, last, rest)
+            p = _predict(model, batch, columns)
+            _accumulate(out, blocks, W, call, _reduce(W, call, first, last, p))
+            held = _input_nbytes(batch) + p.nbytes + sum([_nbytes(r) for r in rest.values()])
+            usage['peak'] = max(usage['peak'], held + fixed + sum([_nbytes(r) for r in out]))
+    if weights is None or np.ndim(weights) < 2:
+        out = [r[0] for r in out]
+    return out
+
+def _nbytes(a):
+    # memory taken by an array, a sparse matrix or None
+    if a is None:
+        return 0
+    if sparse.issparse(a):
+        return a.data.nbytes + a.indices.nbytes + a.indptr.nbytes
+    return a.nbytes
+
+def _input_nbytes(batch):
+    # memory taken by a batch and by the DataFrame made of it for the model
+    return _nbytes(batch) * (1 if sparse.issparse(batch) else 2)
+
+def _output_width(model):
+    # number of outputs of a model, as far as it is known before calling it:
+    # the number of its classes (one for binary problems), or one
+    if isinstance(model, _Stacked_Models):
+        return model.n_outputs()
+    k = len(model.classes_) if hasattr(model, 'classes_') else 1
+    return 1 if k == 2 else k
+
+def _batch_rows(model, X, blocks, W, max_memory=None):
+    # Rows per model call of _evaluate: _BATCH_ROWS (or the batch_size of an
+    # Async_Model), or fewer if they would not fit in max_memory bytes. The
+    # results of all blocks are kept for the whole evaluation, along with the
+    # weights and the settings; each perturbed row takes its copy in the
+    # batch, in the DataFrame given to the model (or in the intermediate
+    # matrices of _sparse_batch) and in the input as validated by the model,
+    # as well as its setting, its predictions and its share of their
+    # reduction. The models of a
+    # _Stacked_Models predict one after the other, so only one validated
+    # copy is held at a time, but their predictions are held twice, before
+    # and after being stacked.
+    rows = model.batch_size if isinstance(model, Async_Model) else _BATCH_ROWS
+    if max_memory is None:
+        return rows
+    k = _output_width(model)
+    held = 2*k if isinstance(model, _Stacked_Models) else k
+    width = max([len(idx) for idx, settings in blocks] + [0])
+    if sparse.issparse(X):
+        per_row = 36*(X.nnz/max(1, X.shape[0]) + width) + 8*held
+    else:
+        per_row = 8*(3*X.shape[1] + width + held)
+    per_row += 8*len(W)*k/max(1, X.shape[0])
+    if isinstance(model, Async_Model):
+        per_row *= model.max_concurrency
+    fixed = 2*_nbytes(W) + sum([8*len(W)*k*len(settings) + _nbytes(settings) for idx, settings in blocks])
+    if fixed + per_row > max_memory:
+        raise ValueError(f"max_memory={max_memory} is too small for this evaluation, which needs at least {int(fixed + per_row)} bytes")
+    return max(1, min(rows, int((max_memory - fixed) // per_row)))
+
+# event loop of the caller of evaluate_async, in the thread running its function
+_caller = threading.local()
+
+def _run_async(coro):
+    # run a coroutine to completion, from synchronous code: in the event loop
+    # of the caller of evaluate_async, if called from there
+    loop = getattr(_caller, 'loop', None)
+    if loop is not None:
+        return asyncio.run_coroutine_threadsafe(coro, loop).result()
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+    # there is already an event loop running in this thread (as in Jupyter
+    # notebooks), which is blocked while waiting, so the coroutine gets its
+    # own loop in another thread
+    with concurrent.futures.ThreadPoolExecutor(1) as executor:
+        return executor.submit(asyncio.run, coro).result()
+
+async def evaluate_async(fn, *args, **kwargs):
+    """
+    Await fn(*args, **kwargs), e.g. a Partial_Dependence, Model_Comparison,
+    feature_importance or interaction_strength of Async_Models, from a
+    coroutine. fn runs in another thread, while the requests of the
+    Async_Models are sent from the running event loop, so that their predict
+    functions can use clients bound to it (e.g. aiohttp or httpx sessions).
+    """
+    loop = asyncio.get_running_loop()
+    def run():
+        _caller.loop = loop
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _caller.loop = None
+    return await loop.run_in_executor(None, run)
+
+class Async_Model():
+    """
+    A model served elsewhere, evaluated through an asynchronous predict
+    function (e.g. a client of a model server), for use in place of a
+    scikit-learn model. predict receives a batch of rows (a pandas DataFrame,
+    or a sparse matrix for sparse data) and returns the model output, one
+    value (or one row of outputs) per row.
+
+    The perturbed rows are sent in batches of about batch_size rows, with at
+    most max_concurrency requests in flight at once. A failed request is
+    retried up to retries times, waiting backoff seconds (doubled at every
+    new attempt) in between. The reduced results of the completed requests of
+    an unfinished computation are kept in progress (a dict, which may be
+    given), so that a computation interrupted by a failure resumes where it
+    stopped when repeated with the same arguments (and random_state, when
+    bootstrapping). classes names the outputs of the model.
+
+    From a coroutine, use evaluate_async, so that the requests are sent
+    from its event loop rather than from a loop of their own.
+    """
+    def __init__(self, predict, batch_size=4096, max_concurrency=8, retries=3, backoff=0.5, progress=None, classes=None):
+        self.predict = predict
+        self.batch_size = batch_size
+        self.max_concurrency = max_concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.progress = progress if progress is not None else dict()
+        if classes is not None:
+            self.classes_ = np.asarray(classes)
+    async def _request(self, batch, columns):
+        if not sparse.issparse(batch):
+            batch = pd.DataFrame(batch, columns=columns)
+        for attempt in range(self.retries+1):
+            try:
+                p = await self.predict(batch)
+                return np.asarray(p, dtype=float).reshape(batch.shape[0], -1)
+            except Exception:
+                if attempt == self.retries:
+                    raise
+                await asyncio.sleep(self.backoff * 2**attempt)
+    async def _evaluate(self, X, columns, blocks, W, batch_rows, out, usage):
+        # Send the calls of _evaluate as concurrent requests. Batches are
+        # only built when a request slot is free, so at most max_concurrency
+        # of them are in memory at any time. Progress is recorded under a
+        # fingerprint of the computation, and dropped once it completes. Once
+        # a request has failed for good, no more are sent: the ones in flight
+        # are awaited, so that their results are kept, and the error raised.
+        key = _fingerprint(X, blocks, W, batch_rows)
+        slots = asyncio.Semaphore(self.max_concurrency)
+        rest = dict()
+        held = [0]
+        fixed = _nbytes(W) + sum([_nbytes(settings) for idx, settings in blocks])
+        errors = list()
+        async def run(i, call, first, last, batch):
+            try:
+                p = await self._request(batch, columns)
+                self.progress[(key, i)] = _reduce(W, call, first, last, p)
+                _accumulate(out, blocks, W, call, self.progress[(key, i)])
+                usage['peak'] = max(usage['peak'], held[0] + p.nbytes + fixed + sum([_nbytes(r) for r in out]))
+            except Exception as e:
+                errors.append(e)
+            finally:
+                held[0] -= _input_nbytes(batch)
+                slots.release()
+        tasks = list()
+        for i, (call, first, last) in enumerate(_batches(blocks, X.shape[0], batch_rows)):
+            if (key, i) in self.progress:
+                _accumulate(out, blocks, W, call, self.progress[(key, i)])
+                continue
+            await slots.acquire()
+            if errors:
+                slots.release()
+                break
+            batch = _perturbed(X, blocks, call, first, last, rest)
+            held[0] += _input_nbytes(batch)
+            tasks.append(asyncio.create_task(run(i, call, first, last, batch)))
+        await asyncio.gather(*tasks)
+        if errors:
+            raise errors[0]
+        for k in [k for k in self.progress if k[0] == key]:
+            del self.progress[k]
+
+def _hash_array(h, a):
+    # Add an array to the hash h without copying it: contiguous arrays are
+    # read in place (Fortran-ordered ones, as read from Arrow and Polars
+    # tables, column by column), others a few rows at a time.
+    a = np.asarray(a)
+    h.update(repr((a.dtype.str, a.shape)).encode())
+    if a.flags.c_contiguous:
+        h.update(a)
+    elif a.flags.f_contiguous:
+        h.update(b'F')
+        h.update(a.T)
+    else:
+        step = max(1, _BATCH_ROWS // max(1, a[0].size))
+        for i in range(0, len(a), step):
+            h.update(np.ascontiguousarray(a[i:i+step]))
+
+def _hash_settings(h, idx, settings):
+    # add the perturbations of a block to the hash h
+    _hash_array(h, np.asarray(idx))
+    for f in _factors(settings):
+        _hash_array(h, f)
+
+def _fingerprint(X, blocks, W, batch_rows):
+    # digest identifying an evaluation (background, perturbations, weights
+    # and batching), used to resume interrupted ones
+    h = hashlib.sha1(repr((X.shape, batch_rows)).encode())
+    for a in ([X.data, X.indices, X.indptr] if sparse.issparse(X) else [X]):
+        _hash_array(h, a)
+    for idx, settings in blocks:
+        _hash_settings(h, idx, settings)
+    _hash_array(h, W)
+    return h.hexdigest()
+
+def _sparse_batch(X, blocks, call, first, last, rest):
+    # Perturbed copies of the rows first:last of the CSR matrix X for one
+    # model call. Only the entries of the perturbed columns are rewritten:
+    # they are dropped from the copies of X, and the settings (their non-zero
+    # values only) are added back, so the batch takes memory proportional to
+    # its non-zeros. rest keeps the rows of X without the columns of the last
+    # block, for the next call.
+    n = last - first
+    pieces = []
+    for b, s, e in call:
+        idx, settings = blocks[b]
+        if (b, first) not in rest:
+            rest.clear()
+            rest[(b, first)] = X[first:last]
+            rest[(b, first)].data[np.isin(rest[(b, first)].indices, idx)] = 0.0
+            rest[(b, first)].eliminate_zeros()
+        values = sparse.csr_matrix(np.asarray(settings[s:e], dtype=float))
+        values = values[np.repeat(np.arange(e-s), n)]
+        values = sparse.csr_matrix((values.data, np.asarray(idx)[values.indices], values.indptr),
+                                   shape=(values.shape[0], X.shape[1]))
+        pieces.append(sparse.vstack([rest[(b, first)]]*(e-s), format='csr') + values)
+    return sparse.vstack(pieces, format='csr')
+
+def _bootstrap_weights(n, n_boot, random_state=None, p=None):
+    # Bootstrap resamples of n rows as a (n_boot, rows) matrix of counts. If
+    # p is given, the rows are drawn with probabilities proportional to p.
+    rng = np.random.default_rng(random_state)
+    p = np.full(n, 1.0/n) if p is None else np.asarray(p)/np.sum(p)
+    return rng.multinomial(n, p, size=n_boot).astype(float)
+
+def _nearest(A, B):
+    # index of the row of B closest to each row of A, computed in chunks
+    o = np.zeros(len(A), dtype=int)
+    b2 = (B**2).sum(axis=1)
+    step = max(1, _BATCH_ROWS // max(1, len(B)))
+    for s in range(0, len(A), step):
+        o[s:s+step] = np.argmin(b2 - 2*A[s:s+step]@B.T, axis=1)
+    return o
+
+def _representatives(X, weights, k, random_state=None, n_iter=20):
+    # Summarise the weighted rows of X by k of them: weighted k-means on the
+    # standardised columns, with each cluster represented by its row closest
+    # to the centroid, carrying the total weight of the cluster. Using actual
+    # rows keeps one-hot columns valid.
+    rng = np.random.default_rng(random_state)
+    scale = X.std(axis=0)
+    scale[scale == 0] = 1.0
+    Z = (X - X.mean(axis=0)) / scale
+    # k-means++ seeding
+    C = [Z[rng.choice(len(Z), p=weights/weights.sum())]]
+    d2 = ((Z - C[0])**2).sum(axis=1)
+    while len(C) < k and (weights*d2).sum() > 0:
+        C.append(Z[rng.choice(len(Z), p=weights*d2/(weights*d2).sum())])
+        d2 = np.minimum(d2, ((Z - C[-1])**2).sum(axis=1))
+    C = np.array(C)
+    for it in range(n_iter):
+        labels = _nearest(Z, C)
+        W = np.bincount(labels, weights, minlength=len(C))
+        newC = np.zeros_like(C)
+        np.add.at(newC, labels, weights[:,None]*Z)
+        newC[W > 0] /= W[W > 0,None]
+        newC[W == 0] = C[W == 0]
+        if np.allclose(newC, C):
+            break
+        C = newC
+    labels = _nearest(Z, C)
+    W = np.bincount(labels, weights, minlength=len(C))
+    rows = _nearest(C, Z)
+    return X[rows[W > 0]], W[W > 0]
+
+def _compress_sparse(X, weights):
+    # _compress for CSR matrices: rows are compared by their non-zero entries
+    X = X.copy()
+    X.sum_duplicates()
+    X.eliminate_zeros()
+    keys = dict()
+    inverse = np.zeros(X.shape[0], dtype=int)
+    for i in range(X.shape[0]):
+        a, b = X.indptr[i], X.indptr[i+1]
+        inverse[i] = keys.setdefault((X.indices[a:b].tobytes(), X.data[a:b].tobytes()), len(keys))
+    first = np.zeros(len(keys), dtype=int)
+    first[inverse[::-1]] = np.arange(X.shape[0])[::-1]
+    return X[first], np.bincount(inverse, weights)
+
+def _compress(X, weights, n_representatives=None, random_state=None):
+    # Collapse the duplicated rows of X into unique rows weighted by their
+    # total weight and, if n_representatives is given, summarise those by as
+    # many weighted representative rows
+    if sparse.issparse(X):
+        if n_representatives is not None:
+            raise NotImplementedError("n_representatives is not available for sparse data")
+        return _compress_sparse(X, weights)
+    X, inverse = np.unique(X, axis=0, return_inverse=True)
+    weights = np.bincount(inverse.ravel(), weights)
+    if n_representatives is not None and n_representatives < len(X):
+        X, weights = _representatives(X, weights, n_representatives, random_state)
+    return X, weights
+
+def _grid(values, grid_resolution=100, percentiles=(0.05, 0.95)):
+    # grid of a real feature, as in scikit-learn: its unique values when there
+    # are few of them, otherwise evenly spaced points between two percentiles
+    uniques = np.unique(values)
+    if len(uniques) < grid_resolution:
+        return uniques
+    lo, hi = mquantiles(values, prob=percentiles)
+    if np.isclose(lo, hi):
+        raise ValueError("The percentiles of a real feature are too close to each other")
+    return np.linspace(lo, hi, grid_resolution)
+
+def _screening_features(columns, X, cat_features, real_features):
+    # (name, column indices, is categorical) of the features to be screened.
+    # Categorical features are groups of one-hot columns found by
+    # _search_features. When no features are given, every column is
+    # screened, with the binary columns sharing a prefix taken as a group
+    # if they are one-hot encoded (as produced by pandas.get_dummies, with
+    # or without drop_first): at most one of them is set in every row.
+    # Other binary columns, such as independent flags, are real features.
+    features = []
+    if not cat_features and not real_features:
+        binary = [c for i,c in enumerate(columns) if '_' in c and np.isin(_column(X, i),(0,1)).all()]
+        prefixes = [c.rsplit('_',1)[0] for c in binary]
+        grouped = set()
+        for p in dict.fromkeys(prefixes):
+            group = [columns.index(c) for c,q in zip(binary, prefixes) if q == p]
+            if len(group) > 1 and (sum([_column(X, j) for j in group]) <= 1).all():
+                features.append((p, group, True))
+                grouped.update(group)
+        return features + [(c, [i], False) for i,c in enumerate(columns) if i not in grouped]
+    for key in cat_features:
+        names = _search_features(columns, key)
+        if not names:
+            raise KeyError(f"No columns found for categorical feature {key}")
+        features.append((key.rstrip('_'), [columns.index(x) for x in names], True))
+    for name in real_features:
+        features.append((name, [columns.index(name)], False))
+    return features
+
+def _supports_recursion(model):
+    # whether scikit-learn's partial_dependence, with method='auto', would
+    # use the recursion method for this model
+    if type(model).__module__.split('.')[0] != 'sklearn':
+        return False
+    from sklearn.ensemble import (GradientBoostingClassifier, GradientBoostingRegressor,
+        HistGradientBoostingClassifier, HistGradientBoostingRegressor, RandomForestRegressor)
+    from sklearn.tree import DecisionTreeRegressor
+    if isinstance(model, (GradientBoostingClassifier, GradientBoostingRegressor)):
+        return model.init is None
+    return isinstance(model, (HistGradientBoostingClassifier, HistGradientBoostingRegressor,
+                              DecisionTreeRegressor, RandomForestRegressor))
+
+def _pd_method(model, method, weighted):
+    # The method used for the partial dependence: 'brute' (averaging the
+    # predictions over the background data) or 'recursion' (traversing the
+    # trees of the model, as scikit-learn does). 'auto' chooses recursion
+    # when scikit-learn would, unless the background is weighted (bootstrap,
+    # sample_weight or n_representatives), which only brute allows.
+    if method not in ('auto', 'brute', 'recursion'):
+        raise ValueError(f"Unknown method: {method}")
+    if method == 'auto':
+        return 'recursion' if _supports_recursion(model) and not weighted else 'brute'
+    if method == 'recursion' and not _supports_recursion(model):
+        raise ValueError(f"The recursion method is not available for {type(model).__name__}")
+    if method == 'recursion' and weighted:
+        raise ValueError("The recursion method can not be used with bootstrap, sample_weight or n_representatives")
+    return method
+
+def _prepare_data(data, background=True, **kwargs):
+    # The data as needed by Partial_Dependence: its float matrix and column
+    # names, used to build the grids, its number of rows and the weighted
+    # background over which the model is evaluated: the unique rows of the
+    # data (if compress) or n_representatives rows summarising them. Finding
+    # the unique rows takes a sorted copy of the data, so for Arrow and
+    # Polars tables, which are read to avoid copies, it is only done if
+    # asked for (with compress=True or n_representatives). Without
+    # background (for the recursion method, which does not read it), the
+    # background is None.
+    X, columns = _background(data, kwargs['feature_names'] if 'feature_names' in kwargs else None)
+    if not background:
+        return X, columns, X.shape[0], None
+    weights = kwargs['sample_weight'] if 'sample_weight' in kwargs else None
+    weights = np.ones(X.shape[0]) if weights is None else np.asarray(weights, dtype=float)
+    n_rep = kwargs['n_representatives'] if 'n_representatives' in kwargs else None
+    compress = kwargs['compress'] if 'compress' in kwargs else (n_rep is not None or not _is_table(data))
+    if compress:
+        random_state = kwargs['random_state'] if 'random_state' in kwargs else None
+        background = _compress(X, weights, n_rep, random_state)
+    else:
+        background = (X, weights)
+    return X, columns, X.shape[0], background
+
 class Partial_Dependence():
+    # number of rows of the table shown by repr() (and print())
+    repr_rows = 20
     def __init__(self, model, data, cat_features=[], real_features=[], **kwargs):
         ncf=len(cat_features)
         nrf=len(real_features)
         self._mode  = 'ND'
+        self._grid_resolution = kwargs['grid_resolution'] if 'grid_resolution' in kwargs else 100
+        # number of bootstrap resamples for the confidence bands (0: no bands)
+        self._bootstrap = kwargs['bootstrap'] if 'bootstrap' in kwargs else 0
+        self._ci = kwargs['ci'] if 'ci' in kwargs else 0.95
+        self._random_state = kwargs['random_state'] if 'random_state' in kwargs else None
+        # evaluations of blocks of perturbations saved from previous
+        # objects built with the same model and data (see PD_Server)
+        self._cache = kwargs['cache'] if 'cache' in kwargs else None
+        # bound (in bytes) of the memory taken by the evaluation of the model
+        self._max_memory = kwargs['max_memory'] if 'max_memory' in kwargs else None
+        self.peak_memory = 0
+        self.method = _pd_method(model, kwargs['method'] if 'method' in kwargs else 'auto',
+                                 self._bootstrap or any([k in kwargs and kwargs[k] is not None
+                                                         for k in ('sample_weight', 'n_representatives')]))
+        if 'prepared' in kwargs:
+            prepared = kwargs['prepared']
+        else:
+            prepared = _prepare_data(data, self.method != 'recursion', **kwargs)
+        self._X, self._columns, self._n_rows, self._background = prepared
         if ncf == 1 and nrf == 0:
             # 1 dimensional PD 
             self._mode = '1DCPD'
@@ -87,10 +704,13 @@ class Partial_Dependence():
             self._run_MDRPD(model, data, real_features)
         else:
             raise NotImplementedError("Requested combination of variables not implemented")
+        # the background data is not needed anymore
+        del self._X, self._background
     def __repr__(self):
-        return self._ascii()
+        # keep the cost of printing bounded, whatever the size of the response
+        return self._ascii(max_rows=self.repr_rows)
     def _search_features(self, data, feature_key):
-        return [x for x in data.columns if x.startswith(feature_key)]
+        return _search_features(self._columns, feature_key)
     def _feature_cleanup(self, feature_key, feature_list):
         return [x.replace(f"{feature_key}_",'').capitalize() for x in feature_list]
     def _find_common_prefix(self, sl):
@@ -103,120 +723,196 @@ class Partial_Dependence():
                 break
         if o.endswith('_'): o = o[:-1]
         return o
+    def _pd(self, model, blocks):
+        # Partial dependence for each output of the model and each block of
+        # perturbations (as [output][block] lists), plus the lower and upper
+        # limits of its bootstrap confidence interval (or None). All outputs
+        # come from the same predictions, and the bootstrap resamples only
+        # re-weight the per-row predictions of that single evaluation pass,
+        # so neither costs extra model calls.
+        weights = self._background[1] if self._background is not None else None
+        if not self._bootstrap:
+            res = self._evaluate(model, blocks, weights)
+            self.outputs = _output_names(model, res[0].shape[-1])
+            return [[r[:,k] for r in res] for k in range(len(self.outputs))], None, None
+        # resampling the rows of the original data is resampling the rows of
+        # the background with probabilities proportional to their weights
+        counts = _bootstrap_weights(self._n_rows, self._bootstrap, self._random_state, weights)
+        res = self._evaluate(model, blocks, np.vstack([weights, counts]))
+        self.outputs = _output_names(model, res[0].shape[-1])
+        alpha = (1.0-self._ci)/2
+        lower = [np.quantile(r[1:], alpha, axis=0) for r in res]
+        upper = [np.quantile(r[1:], 1.0-alpha, axis=0) for r in res]
+        return ([[r[0,:,k] for r in res] for k in range(len(self.outputs))],
+                [[l[:,k] for l in lower] for k in range(len(self.outputs))],
+                [[u[:,k] for u in upper] for k in range(len(self.outputs))])
+    def _evaluate(self, model, blocks, weights):
+        # _evaluate over the background, taking the blocks already evaluated
+        # with the same weights from the cache, if there is one, and keeping
+        # the peak memory taken
+        if self._cache is None:
+            return self._evaluate_blocks(model, blocks, weights)
+        keys = list()
+        for idx, settings in blocks:
+            h = hashlib.sha1()
+            _hash_settings(h, idx, settings)
+            if weights is not None:
+                _hash_array(h, weights)
+            h.update(self.method.encode())
+            keys.append(h.hexdigest())
+        res = {k: self._cache.get(k) for k in keys}
+        missing = [i for i,k in enumerate(keys) if res[k] is None]
+        if missing:
+            new = self._evaluate_blocks(model, [blocks[i] for i in missing], weights)
+            for i, r in zip(missing, new):
+                res[keys[i]] = self._cache[keys[i]] = r
+        return [res[k] for k in keys]
+    def _evaluate_blocks(self, model, blocks, weights):
+        if self.method == 'recursion':
+            # the trees are traversed once per setting, without using the data
+            return [np.hstack([np.atleast_2d(model._compute_partial_dependence_recursion(
+                        np.asarray(settings[s:s+_BATCH_ROWS], dtype=np.float32, order='C'),
+                        np.asarray(idx, dtype=np.intp))) for s in range(0, len(settings), _BATCH_ROWS)]).T
+                    for idx, settings in blocks]
+        usage = dict()
+        res = _evaluate(model, self._background[0], self._columns, blocks, weights, self._max_memory, usage)
+        self.peak_memory = max(self.peak_memory, usage['peak'])
+        return res
+    def _store(self, responses, lower=None, upper=None):
+        # keep the response (and its confidence limits) for every output of
+        # the model; response is the one of the first output
+        self.responses = responses
+        self.responses_lower = lower
+        self.responses_upper = upper
+        self.response = responses[0]
+        self.response_lower = lower[0] if lower else None
+        self.response_upper = upper[0] if upper else None
+    def _output_index(self, output):
+        # index of an output, given by its position or name
+        if output in self.outputs:
+            return self.outputs.index(output)
+        if isinstance(output, (int, np.integer)) and -len(self.outputs) <= output < len(self.outputs):
+            return output % len(self.outputs)
+        raise KeyError(f"Unknown output: {output}")
+    def _for_outputs(self, output):
+        # Views of this object for the requested outputs (None: the first
+        # one; 'all': every output), each with its response in the usual
+        # attributes
+        idx = range(len(self.outputs)) if output == 'all' else [self._output_index(output or 0)]
+        o = []
+        for k in idx:
+            v = copy.copy(self)
+            v.response = self.responses[k]
+            v.response_lower = self.responses_lower[k] if self.responses_lower else None
+            v.response_upper = self.responses_upper[k] if self.responses_upper else None
+            o.append((self.outputs[k], v))
+        return o
+    def _select_outputs(self, idx, outputs):
+        # a copy of this object keeping only the outputs in positions idx,
+        # which are renamed outputs
+        v = copy.copy(self)
+        v.outputs = list(outputs)
+        v._store([self.responses[k] for k in idx],
+                 self.responses_lower and [self.responses_lower[k] for k in idx],
+                 self.responses_upper and [self.responses_upper[k] for k in idx])
+        return v
     def _run_1DCPD(self, model, data, feature_key):
         x_names = self._search_features(data, feature_key)
-        response = np.zeros(len(x_names))
-        pdep = partial_dependence(model, data, x_names)
-        for i, i_name in enumerate(x_names):
-            s = 'pdep[0][0]'
-            for ii in range(len(x_names)):
-                if ii == i:
-                    s += '[1]'
-                else:
-                    s += '[0]'
-            response[i]=eval(s)
+        X, columns = self._X, self._columns
+        idx = [columns.index(x) for x in x_names]
+        r, lower, upper = self._pd(model, [(idx, np.eye(len(idx)))])
         # expose data to the object's namespace
         self.x_name = feature_key.capitalize()
         self.y_name = None
         self.x_vals = self._feature_cleanup(feature_key, x_names)
         self.y_vals = None
-        self.response = response
+        self._store([v[0] for v in r], lower and [v[0] for v in lower], upper and [v[0] for v in upper])
     def _run_2DCPD(self, model, data, feature_keys):
         x_names = self._search_features(data, feature_keys[0])
         y_names = self._search_features(data, feature_keys[1])
-        response = np.zeros((len(x_names),len(y_names)))
-        pdep = partial_dependence(model, data, x_names + y_names)
-        for i, i_name in enumerate(x_names):
-            for j, j_name in enumerate(y_names):
-                s = 'pdep[0][0]'
-                for ii in range(len(x_names)):
-                    if ii == i:
-                        s += '[1]'
-                    else:
-                        s += '[0]'
-                for jj in range(len(y_names)):
-                    if jj == j:
-                        s += '[1]'
-                    else:
-                        s += '[0]'
-                response[i,j]=eval(s)
+        X, columns = self._X, self._columns
+        idx = [columns.index(x) for x in x_names + y_names]
+        nx, ny = len(x_names), len(y_names)
+        # one setting for every combination of the two one-hot groups
+        settings = _Settings(np.eye(nx), np.eye(ny))
+        r, lower, upper = self._pd(model, [(idx, settings)])
+        table = lambda v: [vk[0].reshape(nx, ny) for vk in v] if v else None
         # expose data to the object's namespace
         self.x_name = feature_keys[0].capitalize()
         self.y_name = feature_keys[1].capitalize()
         self.x_vals = self._feature_cleanup(feature_keys[0], x_names)
         self.y_vals = self._feature_cleanup(feature_keys[1], y_names)
-        self.response = response
+        self._store(table(r), table(lower), table(upper))
     def _run_2DCRPD(self, model, data, cat_feature, real_feature):
         x_names = self._search_features(data, cat_feature)
         x_vals  = self._feature_cleanup(cat_feature, x_names) 
-        response = list()
-        # set the data so that all features share the same range
-        pseudo_data = data.copy()
-        pseudo_data.loc[0, real_feature]=data[real_feature].min()
-        pseudo_data.loc[1, real_feature]=data[real_feature].max()
-        for i, xn in enumerate(x_names):
-            pdep = partial_dependence(model, pseudo_data, [xn,real_feature])
-            for j,y_val in enumerate(pdep[1][1]):
-                response.append([x_vals[i],y_val,pdep[0][0][1][j]])
+        X, columns = self._X, self._columns
+        idx = [columns.index(x) for x in x_names + [real_feature]]
+        # all categories share the same grid of the real feature
+        grid = _grid(_column(X, idx[-1]), self._grid_resolution)
+        nx, ng = len(x_names), len(grid)
+        settings = _Settings(np.eye(nx), grid)
+        r, lower, upper = self._pd(model, [(idx, settings)])
+        responses = list()
+        for rk in r:
+            response = list()
+            for i in range(nx):
+                for j,y_val in enumerate(grid):
+                    response.append([x_vals[i],y_val,rk[0][i*ng+j]])
+            responses.append(response)
         # expose data to the object's namespace
-        self.response = response
+        self._store(responses, lower and [v[0] for v in lower], upper and [v[0] for v in upper])
         self.x_name = cat_feature.capitalize()
         self.x_vals = x_vals
         self.y_name = real_feature.capitalize()
         self.y_vals = None
     def _run_2DRPD(self, model, data, real_features):
-        #x_names = self._search_features(data, cat_feature)
-        #x_vals  = self._feature_cleanup(cat_feature, x_names) 
-        response = list()
-        # set the data so that all features share the same range
-        #pseudo_data = data.copy()
-        #pseudo_data.loc[0, real_feature]=data[real_feature].min()
-        #pseudo_data.loc[1, real_feature]=data[real_feature].max()
-        pdep = partial_dependence(model, data, real_features)
-        for i,x in enumerate(pdep[1][0]):
-            for j,y in enumerate(pdep[1][1]):
-                response.append([x,y,pdep[0][0][i,j]])
+        X, columns = self._X, self._columns
+        idx = [columns.index(x) for x in real_features]
+        x_grid = _grid(_column(X, idx[0]), self._grid_resolution)
+        y_grid = _grid(_column(X, idx[1]), self._grid_resolution)
+        settings = _Settings(x_grid, y_grid)
+        r, lower, upper = self._pd(model, [(idx, settings)])
+        responses = list()
+        for rk in r:
+            response = list()
+            for i,x in enumerate(x_grid):
+                for j,y in enumerate(y_grid):
+                    response.append([x,y,rk[0][i*len(y_grid)+j]])
+            responses.append(response)
         # expose data to the object's namespace
-        self.response = response
+        self._store(responses, lower and [v[0] for v in lower], upper and [v[0] for v in upper])
         self.x_name = real_features[0].capitalize()
-        self.x_vals = pdep[1][0]
+        self.x_vals = x_grid
         self.y_name = real_features[1].capitalize()
-        self.y_vals = pdep[1][1]
+        self.y_vals = y_grid
     def _run_MDRPDWS(self, model, data, feature_key):
-        feature_names = self._search_features(data,feature_key)
         self._run_MDRPD(model, data, self._search_features(data,feature_key))
         self.x_name = feature_key.capitalize()
         self.y_name = feature_key.capitalize() + ' Value'
     def _run_MDRPD(self, model, data, real_features):
-        # set the data so that all features share the same range
-        #pseudo_data = data.copy()
-        #y_min =  np.inf
-        #y_max = -np.inf
-        #print(data)
-        #for name in real_features:
-        #    print(f"{name}: {min(data[name])} - {max(data[name])}")
-        #    if min(data[name])< y_min: y_min = min(data[name])
-        #    if max(data[name])> y_max: y_max = max(data[name])
-        #print(y_min, y_max)
-        #npoints = len(data)
-        #for name in real_features:
-        #    pseudo_data[name]=np.linspace(y_min,y_max,npoints)
-        #    #pseudo_data[name][0]=y_min
-        #    #pseudo_data[name][1]=y_max
         # Saving the response to a list x,y,model_response
-        response = list()
         try:
             x_vals = [int(x.split('_')[-1]) for x in real_features]
         except:
             raise TypeError("Unsuported format of real variables.")
-        for i, xn in enumerate(real_features):
-            #pdep = partial_dependence(model, pseudo_data, [xn])
-            pdep = partial_dependence(model, data, [xn])
-            for j,ypos in enumerate(pdep[1][0]):
-                response.append([x_vals[i], ypos, pdep[0][0][j]])
-            #print(x_vals[i],min(r[1] for r in response),max(r[1] for r in response))
+        X, columns = self._X, self._columns
+        # one block per feature, all evaluated in the same batched pass
+        blocks = list()
+        for xn in real_features:
+            j = columns.index(xn)
+            blocks.append(([j], _grid(_column(X, j), self._grid_resolution)[:,None]))
+        r, lower, upper = self._pd(model, blocks)
+        responses = list()
+        for rk in r:
+            response = list()
+            for i, (j, grid) in enumerate(blocks):
+                for k,ypos in enumerate(grid[:,0]):
+                    response.append([x_vals[i], ypos, rk[i][k]])
+            responses.append(np.array(response))
         # expose data to the object's namespace
-        self.response = np.array(response)
+        self._store(responses, lower and [np.concatenate(v) for v in lower],
+                    upper and [np.concatenate(v) for v in upper])
         self.x_name = self._find_common_prefix(real_features)
         self.x_vals = x_vals
         self.y_name = self.x_name + ' Values'
@@ -240,152 +936,206 @@ class Partial_Dependence():
             o.append(2+max(8,len("Model Response")))
         else:
             raise NotImplementedError(f"Unknown mode: {self._mode}")
+        if self._ascii_bands():
+            o += [2+max(8,len("Lower")), 2+max(8,len("Upper"))]
         return o
-    def _ascii(self, **kwargs):
-        s=""
+    def _ascii_bands(self):
+        # confidence bands are shown as two extra columns in the tables which
+        # have a single column of responses
+        return self.response_lower is not None and self._mode not in ('2DCPD','2DCRPD')
+    def _crpd_table(self):
+        # y values (in ascending order) and a (x, y) -> response index lookup for 2DCRPD
+        lookup = {(r[0], r[1]): i for i,r in enumerate(self.response)}
+        y_vals = sorted(set([r[1] for r in self.response]))
+        return y_vals, lookup
+    def _ascii_layout(self):
+        # column widths, horizontal rule, header cells, one format per column,
+        # a function giving the values of the i-th row and the number of rows
         col_widths = self._get_col_widths()
         if self._mode=='1DCPD':
-            s += '-'*col_widths[0] + ' ' + '-'*col_widths[1] + '\n'
-            s += f"{self.x_name:^{col_widths[0]}s}  Model Response\n"
-            s += '-'*col_widths[0] + ' ' + '-'*col_widths[1] + '\n'
-            for i,x in enumerate(self.x_vals):
-                s += f"{x:^{col_widths[0]}s} {self.response[i]:+{col_widths[1]}.{col_widths[1]-5}g}\n"
-            s += '-'*col_widths[0] + ' ' + '-'*col_widths[1] + '\n'
+            header = [f"{self.x_name:^{col_widths[0]}s} ", " Model Response"]
+            fmts = [f"{{:^{col_widths[0]}s}} ",
+                    f"{{:+{col_widths[1]}.{col_widths[1]-5}g}}"]
+            row = lambda i: (self.x_vals[i], self.response[i])
+            nrows = len(self.x_vals)
         elif self._mode=='2DCPD':
-            for cw in col_widths:
-                s += '-'*cw + ' '
-            s += '\n'
             t = f"{self.x_name}/{self.y_name}"
-            s += f"{t:^{col_widths[0]}s} "
-            for i,cn in enumerate(self.y_vals):
-                s += f"{cn:^{col_widths[i+1]}s} "
-            s += '\n'
-            for cw in col_widths:
-                s += '-'*cw + ' '
-            s += '\n'
-            for i, rv in enumerate(self.x_vals):
-                s += f"{rv:^{col_widths[0]}s} "
-                for j, cv in enumerate(self.y_vals):
-                    s += f"{self.response[i,j]:+{col_widths[j+1]}.{col_widths[j+1]-5}g} "
-                s += '\n'
-            for cw in col_widths:
-                s += '-'*cw + ' '
-            s += '\n'
+            header = [f"{t:^{col_widths[0]}s} "]
+            header += [f"{cn:^{col_widths[i+1]}s} " for i,cn in enumerate(self.y_vals)]
+            fmts = [f"{{:^{col_widths[0]}s}} "]
+            fmts += [f"{{:+{cw}.{cw-5}g}} " for cw in col_widths[1:]]
+            row = lambda i: (self.x_vals[i],) + tuple(self.response[i])
+            nrows = len(self.x_vals)
         elif self._mode=='2DCRPD':
-            for cw in col_widths:
-                s += '-'*cw + ' '
-            s += '\n'
-            s += f"{self.y_name:^{col_widths[0]}s} "
-            for i,xv in enumerate(self.x_vals):
-                s += f"{xv:^{col_widths[i+1]}s} "
-            s += '\n'
-            for cw in col_widths:
-                s += '-'*cw + ' '
-            s += '\n'
-            for i,yv in enumerate(list(set([x[1] for x in self.response]))):
-                s += f"{yv:{col_widths[0]}.{col_widths[0]-5}g} "
-                for j, xv in enumerate(self.x_vals):
-                    r = [x for x in self.response if x[0]==xv and x[1]==yv]
-                    if r:
-                        s += f"{r[0][2]:+{col_widths[j+1]}.{col_widths[j-1]-5}g} "
-                    else:
-                        s += ' '*(col_widths[j+1]+1)
-                s += '\n'
-            for cw in col_widths:
-                s += '-'*cw + ' '
-            s += '\n'
+            header = [f"{self.y_name:^{col_widths[0]}s} "]
+            header += [f"{xv:^{col_widths[i+1]}s} " for i,xv in enumerate(self.x_vals)]
+            fmts = [f"{{:{col_widths[0]}.{col_widths[0]-5}g}} "]
+            fmts += [f"{{:+{cw}.{cw-5}g}} " for cw in col_widths[1:]]
+            y_vals, lookup = self._crpd_table()
+            cell = lambda k: None if k is None else self.response[k][2]
+            row = lambda i: (y_vals[i],) + tuple(cell(lookup.get((xv, y_vals[i]))) for xv in self.x_vals)
+            nrows = len(y_vals)
         elif self._mode=='MDRPDWS' or self._mode=='MDRPD' or self._mode=='2DRPD':
-            for cw in col_widths:
-                s += '-'*cw + ' '
-            s += '\n'
-            s += f"{self.x_name:^{col_widths[0]}s} "
-            s += f"{self.y_name:^{col_widths[1]}s} "
             t="Model Response"
-            s += f"{t:^{col_widths[2]}s} "
-            s += '\n'
-            for cw in col_widths:
-                s += '-'*cw + ' '
-            s += '\n'
-            for l in self.response:
-                for i in range(len(col_widths)):
-                    s += f"{l[i]:{col_widths[i]}.{col_widths[i]-5}g} "
-                s += '\n'
-            for cw in col_widths:
-                s += '-'*cw + ' '
-            s += '\n'
+            header = [f"{self.x_name:^{col_widths[0]}s} ",
+                      f"{self.y_name:^{col_widths[1]}s} ",
+                      f"{t:^{col_widths[2]}s} "]
+            fmts = [f"{{:{cw}.{cw-5}g}} " for cw in col_widths]
+            row = lambda i: self.response[i]
+            nrows = len(self.response)
         else:
             raise NotImplementedError(f"Unknown mode: {self._mode}")
-        return s
-    def print_ascii(self, **kwargs):
-        print(self._ascii(**kwargs))
-    def plot(self, fn=None, **kwargs):
-        fig, ax = plt.subplots()
+        if self._ascii_bands():
+            if self._mode=='1DCPD':
+                header += [f" {t:^{cw}s}" for t,cw in zip(("Lower","Upper"), col_widths[-2:])]
+                fmts += [f" {{:+{cw}.{cw-5}g}}" for cw in col_widths[-2:]]
+            else:
+                header += [f"{t:^{cw}s} " for t,cw in zip(("Lower","Upper"), col_widths[-2:])]
+                fmts += [f"{{:+{cw}.{cw-5}g}} " for cw in col_widths[-2:]]
+            values = row
+            row = lambda i: tuple(values(i)) + (self.response_lower[i], self.response_upper[i])
+        rule = ' '.join(['-'*cw for cw in col_widths])
+        if self._mode!='1DCPD':
+            rule += ' '
+        return col_widths, rule, header, fmts, row, nrows
+    def _write_ascii(self, f, max_rows=None, output=None, **kwargs):
+        # Write the ascii table of the selected output (or one table per
+        # output, for output='all') to the file-like object f.
+        views = self._for_outputs(output)
+        for label, v in views:
+            if len(views) > 1:
+                f.write(f"Output: {label}\n")
+            v._write_table(f, max_rows)
+    def _write_table(self, f, max_rows=None):
+        # Write the ascii table to the file-like object f. In the maps of
+        # 2DCPD and 2DCRPD, the confidence limits follow as two more tables,
+        # as in to_csv.
+        tables = [self]
+        if self.response_lower is not None and self._mode in ('2DCPD','2DCRPD'):
+            tables += [self._band_table(" Lower", self.response_lower),
+                       self._band_table(" Upper", self.response_upper)]
+        for k, t in enumerate(tables):
+            if k:
+                f.write('\n')
+            t._write_rows(f, max_rows)
+    def _band_table(self, title, values):
+        # a copy of this object showing values (the lower or upper limits)
+        # as its response, with title appended to the name of its y axis
+        v = copy.copy(self)
+        v.y_name = self.y_name + title
+        v.response_lower = v.response_upper = None
+        if self._mode=='2DCPD':
+            v.response = values
+        else:
+            v.response = [[r[0], r[1], b] for r,b in zip(self.response, values)]
+        return v
+    def _write_rows(self, f, max_rows=None):
+        # Write one ascii table to the file-like object f, one line at a time.
+        # If max_rows is given, only the first and last max_rows//2 rows are
+        # written, separated by a line of ellipsis.
+        col_widths, rule, header, fmts, row, nrows = self._ascii_layout()
+        if max_rows is None or nrows <= max_rows:
+            head, tail = nrows, 0
+        else:
+            head = max_rows - max_rows//2
+            tail = max_rows//2
+        f.write(rule + '\n')
+        f.write(''.join(header) + '\n')
+        f.write(rule + '\n')
+        for i in itertools.chain(range(head), [None], range(nrows-tail, nrows)):
+            if i is None:
+                if head + tail < nrows:
+                    f.write(''.join([f"{'...':^{cw}s} " for cw in col_widths]) + '\n')
+                continue
+            cells = [fmt.format(v) if v is not None else ' '*(col_widths[j]+1)
+                     for j,(fmt,v) in enumerate(zip(fmts, row(i)))]
+            f.write(''.join(cells) + '\n')
+        f.write(rule + '\n')
+        if head + tail < nrows:
+            f.write(f"[{nrows} rows, {nrows-head-tail} not shown]\n")
+    def _ascii(self, **kwargs):
+        s = io.StringIO()
+        self._write_ascii(s, **kwargs)
+        return s.getvalue()
+    def print_ascii(self, f=None, **kwargs):
+        self._write_ascii(f if f is not None else sys.stdout, **kwargs)
+    def _heatmap(self, ax, z, **kwargs):
+        cmap = kwargs['cmap'] if 'cmap' in kwargs else 'RdYlGn'
+        im = ax.imshow(z, cmap=cmap)
+        # For the heatmap, we need to transpose the x and y labels
+        ax.set_xticks(np.arange(len(self.y_vals)))
+        ax.set_yticks(np.arange(len(self.x_vals)))
+        ax.set_xticklabels(self.y_vals)
+        ax.set_yticklabels(self.x_vals)
+        cbar = ax.figure.colorbar(im, ax=ax)
+        ax.set_xlabel(self.y_name)
+        ax.set_ylabel(self.x_name)
+    def _contour(self, ax, z_pts, **kwargs):
+        x_pts = [float(r[0]) for r in self.response]
+        y_pts = [float(r[1]) for r in self.response]
+        x_min = kwargs['xlim'][0] if 'xlim' in kwargs else min(x_pts)
+        x_max = kwargs['xlim'][1] if 'xlim' in kwargs else max(x_pts)
+        y_min = kwargs['ylim'][0] if 'ylim' in kwargs else min(y_pts)
+        y_max = kwargs['ylim'][1] if 'ylim' in kwargs else max(y_pts)
+        cmap = kwargs['cmap'] if 'cmap' in kwargs else 'RdYlGn'
+        npoints = kwargs['npoints'] if 'npoints' in kwargs else 1024
+        xi = np.linspace(x_min,x_max, npoints)
+        yi = np.linspace(y_min,y_max, npoints)
+        tt = tri.Triangulation(x_pts,y_pts)
+        interpolator = tri.LinearTriInterpolator(tt, z_pts)
+        Xi, Yi = np.meshgrid(xi, yi)
+        zi = interpolator(Xi, Yi)
+        grph = ax.contourf(xi, yi, zi, cmap= cmap)
+        ax.figure.colorbar(grph, ax=ax)
+        ax.set_xlabel(self.x_name)
+        ax.set_ylabel(self.y_name)
+    def plot(self, fn=None, output=None, **kwargs):
+        # one row of panels for the selected output, or for each output
+        # (output='all'); maps get a second panel, showing the width of the
+        # confidence interval
+        views = self._for_outputs(output)
+        ncols = 1
+        if self.response_lower is not None and self._mode in ('2DCPD','MDRPDWS','MDRPD','2DRPD'):
+            ncols = 2
+        fig, axes = plt.subplots(len(views), ncols, figsize=(6.4*ncols, 4.8*len(views)), squeeze=False)
+        for (label, v), row in zip(views, axes):
+            v._draw(*row, **kwargs)
+            if len(self.outputs) > 1:
+                row[0].set_title(f"{label}")
+        if fn:
+            fig.savefig(fn)
+            plt.close(fig)
+        else:
+            plt.show()
+    def _draw(self, ax, ax_ci=None, **kwargs):
+        bands = self.response_lower is not None
+        if ax_ci is not None:
+            ax_ci.set_title(f"Width of the {self._ci:.0%} confidence interval")
         if self._mode=='1DCPD':
-            bar = ax.bar(self.x_vals, self.response)
+            yerr = None
+            if bands:
+                yerr = [self.response-self.response_lower, self.response_upper-self.response]
+            bar = ax.bar(self.x_vals, self.response, yerr=yerr, capsize=4)
         elif self._mode=='2DCPD':
-            cmap = kwargs['cmap'] if 'cmap' in kwargs else 'RdYlGn'
-            im = ax.imshow(self.response, cmap=cmap)
-            # For the heatmap, we need to transpose the x and y labels
-            ax.set_xticks(np.arange(len(self.y_vals)))
-            ax.set_yticks(np.arange(len(self.x_vals)))
-            ax.set_xticklabels(self.y_vals)
-            ax.set_yticklabels(self.x_vals)
-            cbar = ax.figure.colorbar(im, ax=ax)
-            ax.set_xlabel(self.y_name)
-            ax.set_ylabel(self.x_name)
+            self._heatmap(ax, self.response, **kwargs)
+            if bands:
+                self._heatmap(ax_ci, self.response_upper-self.response_lower, **kwargs)
         elif self._mode=='2DCRPD':
             for cn in self.x_vals:
-                xy = [r for r in self.response if r[0]==cn ]
-                ax.plot([r[1] for r in xy],[r[2] for r in xy], label=cn)
+                idx = [i for i,r in enumerate(self.response) if r[0]==cn]
+                line, = ax.plot([self.response[i][1] for i in idx],[self.response[i][2] for i in idx], label=cn)
+                if bands:
+                    ax.fill_between([self.response[i][1] for i in idx], self.response_lower[idx],
+                                    self.response_upper[idx], color=line.get_color(), alpha=0.25)
             ax.set_xlabel(self.y_name)
             ax.set_ylabel("Model Response")
             ax.legend(title=self.x_name)
-        elif self._mode=='MDRPDWS' or self._mode=='MDRPD':
-            x_pts = [float(r[0]) for r in self.response]
-            y_pts = [r[1] for r in self.response]
-            z_pts = [r[2] for r in self.response]
-            x_min = kwargs['xlim'][0] if 'xlim' in kwargs else min(x_pts)
-            x_max = kwargs['xlim'][1] if 'xlim' in kwargs else max(x_pts)
-            y_min = kwargs['ylim'][0] if 'ylim' in kwargs else min(y_pts)
-            y_max = kwargs['ylim'][1] if 'ylim' in kwargs else max(y_pts)
-            cmap = kwargs['cmap'] if 'cmap' in kwargs else 'RdYlGn'
-            npoints = kwargs['npoints'] if 'npoints' in kwargs else 1024
-            xi = np.linspace(x_min,x_max, npoints)
-            yi = np.linspace(y_min,y_max, npoints)
-            tt = tri.Triangulation(x_pts,y_pts)
-            interpolator = tri.LinearTriInterpolator(tt, z_pts)
-            Xi, Yi = np.meshgrid(xi, yi)
-            zi = interpolator(Xi, Yi)
-            grph = ax.contourf(xi, yi, zi, cmap= cmap)
-            fig. colorbar(grph)
-            ax.set_xlabel(self.x_name)
-            ax.set_ylabel(self.y_name)
-        elif self._mode=='2DRPD':
-            x_pts = [r[0] for r in self.response]
-            y_pts = [r[1] for r in self.response]
-            z_pts = [r[2] for r in self.response]
-            x_min = kwargs['xlim'][0] if 'xlim' in kwargs else min(x_pts)
-            x_max = kwargs['xlim'][1] if 'xlim' in kwargs else max(x_pts)
-            y_min = kwargs['ylim'][0] if 'ylim' in kwargs else min(y_pts)
-            y_max = kwargs['ylim'][1] if 'ylim' in kwargs else max(y_pts)
-            cmap = kwargs['cmap'] if 'cmap' in kwargs else 'RdYlGn'
-            npoints = kwargs['npoints'] if 'npoints' in kwargs else 1024
-            xi = np.linspace(x_min,x_max, npoints)
-            yi = np.linspace(y_min,y_max, npoints)
-            tt = tri.Triangulation(x_pts,y_pts)
-            interpolator = tri.LinearTriInterpolator(tt, z_pts)
-            Xi, Yi = np.meshgrid(xi, yi)
-            zi = interpolator(Xi, Yi)
-            grph = ax.contourf(xi, yi, zi, cmap= cmap)
-            fig. colorbar(grph)
-            ax.set_xlabel(self.x_name)
-            ax.set_ylabel(self.y_name)
+        elif self._mode=='MDRPDWS' or self._mode=='MDRPD' or self._mode=='2DRPD':
+            self._contour(ax, [r[2] for r in self.response], **kwargs)
+            if bands:
+                self._contour(ax_ci, self.response_upper-self.response_lower, **kwargs)
         else:
             raise NotImplementedError(f"Unknown mode: {self._mode}")
-        if fn:
-            plt.saveimage(fn)
-        else:
-            plt.show()
     def to_gnuplot(self, fn, **kwargs):
         #TODO
         if self._mode=='1DCPD':
@@ -410,62 +1160,425 @@ class Partial_Dependence():
             pass
         else:
             raise NotImplementedError(f"Unknown mode: {self._mode}")
-    def to_csv(self, fn, **kwargs):
+    def to_dict(self):
+        # the partial dependence as a dictionary of plain Python values
+        # (lists, numbers and strings), ready to be written as JSON
+        o = dict(mode=self._mode, method=self.method, x_name=self.x_name, y_name=self.y_name,
+                 x_vals=self.x_vals, y_vals=self.y_vals, outputs=self.outputs,
+                 responses=self.responses, responses_lower=self.responses_lower,
+                 responses_upper=self.responses_upper)
+        return {k: _plain(v) for k,v in o.items()}
+    def to_csv(self, fn, output=None, **kwargs):
+        # the selected output or, for output='all', one table per output
         with open(fn,'w', newline='') as f:
             csw = csv.writer(f)
-            if self._mode=='1DCPD':
-                csw.writerow([self.x_name,"Model Response"])
-                for i,x in enumerate(self.x_vals):
-                    csw.writerow([x,self.response[i]])
-            elif self._mode=='2DCPD':
-                csw.writerow([f"{self.x_name}/{self.y_name}"]+self.y_vals)
+            views = self._for_outputs(output)
+            for k,(label, v) in enumerate(views):
+                if len(views) > 1:
+                    if k:
+                        csw.writerow([])
+                    csw.writerow([f"Output: {label}"])
+                v._write_csv(csw)
+    def _write_csv(self, csw):
+        bands = self.response_lower is not None
+        if self._mode=='1DCPD':
+            csw.writerow([self.x_name,"Model Response"]+(["Lower","Upper"] if bands else []))
+            for i,x in enumerate(self.x_vals):
+                csw.writerow([x,self.response[i]]+([self.response_lower[i],self.response_upper[i]] if bands else []))
+        elif self._mode=='2DCPD':
+            # the confidence limits follow as two more tables
+            tables = [("", self.response)]
+            if bands:
+                tables += [(" Lower", self.response_lower), (" Upper", self.response_upper)]
+            for k,(t,table) in enumerate(tables):
+                if k:
+                    csw.writerow([])
+                csw.writerow([f"{self.x_name}/{self.y_name}{t}"]+self.y_vals)
                 for i,rv in enumerate(self.x_vals):
-                    csw.writerow([rv]+[self.response[i,j] for j in range(len(self.y_vals))])
-            elif self._mode=='2DCRPD':
-                csw.writerow([f"{self.y_name}/{self.x_name}"]+self.x_vals)
-                for i,yv in enumerate(list(set([x[1] for x in self.response]))):
-                    row = [yv]
-                    for j, xv in enumerate(self.x_vals):
-                        r = [x for x in self.response if x[0]==xv and x[1]==yv]
-                        if r:
-                            row.append(r[0][2])
-                        else:
-                            row.append('NA')
-                    csw.writerow(row)
-            elif self._mode=='MDRPDWS' or self._mode=='MDRPD' or self._mode=='2DRPD':
-                csw.writerow([f"{self.x_name}", f"{self.y_name}", "Model Response"])
-                for l in self.response:
-                    csw.writerow(l)
-            else:
-                raise NotImplementedError(f"Unknown mode: {self._mode}")
+                    csw.writerow([rv]+[table[i,j] for j in range(len(self.y_vals))])
+        elif self._mode=='2DCRPD':
+            y_vals, lookup = self._crpd_table()
+            tables = [("", [r[2] for r in self.response])]
+            if bands:
+                tables += [(" Lower", self.response_lower), (" Upper", self.response_upper)]
+            for k,(t,table) in enumerate(tables):
+                if k:
+                    csw.writerow([])
+                csw.writerow([f"{self.y_name}/{self.x_name}{t}"]+self.x_vals)
+                for yv in y_vals:
+                    idx = [lookup.get((xv, yv)) for xv in self.x_vals]
+                    csw.writerow([yv]+['NA' if i is None else table[i] for i in idx])
+        elif self._mode=='MDRPDWS' or self._mode=='MDRPD' or self._mode=='2DRPD':
+            csw.writerow([f"{self.x_name}", f"{self.y_name}", "Model Response"]+(["Lower","Upper"] if bands else []))
+            for i,l in enumerate(self.response):
+                csw.writerow(list(l)+([self.response_lower[i],self.response_upper[i]] if bands else []))
+        else:
+            raise NotImplementedError(f"Unknown mode: {self._mode}")
+
+class _Stacked_Models():
+    # Several models seen as one, whose outputs are those of every model
+    # followed, when all models have the same outputs (classifiers with the
+    # same classes in the same order, or regressors with as many outputs), by
+    # the differences between those of each model and those of the first
+    # one. widths holds the number of outputs of each model and names their
+    # names, as estimated before the first call and known after it.
+    def __init__(self, models):
+        self.models = models
+        self._set_widths([_output_width(m) for m in models])
+    def _set_widths(self, widths):
+        self.widths = widths
+        self.names = [_output_names(m, w) for m, w in zip(self.models, widths)]
+        kinds = set([hasattr(m, 'predict_proba') for m in self.models])
+        self.comparable = len(kinds) == 1 and all([n == self.names[0] for n in self.names])
+    def n_outputs(self):
+        return sum(self.widths) + (self.widths[0]*(len(self.models)-1) if self.comparable else 0)
+    def predict(self, X):
+        # the models are given the same DataFrame, one after the other
+        columns = None if sparse.issparse(X) else X.columns
+        p = [_predict(m, X, columns) for m in self.models]
+        if [q.shape[1] for q in p] != self.widths:
+            self._set_widths([q.shape[1] for q in p])
+        if self.comparable:
+            p += [q - p[0] for q in p[1:]]
+        return np.hstack(p)
+
+class Model_Comparison():
+    """
+    Partial dependence of several models (e.g. successive versions of one
+    model) on the same data and features. The perturbed data are built only
+    once, and each batch of them is predicted by all models before the next
+    one is built, so comparing N models costs N predictions of the batches,
+    not N whole computations. kwargs are passed on to Partial_Dependence.
+
+    results holds one Partial_Dependence object per model, all on the same
+    grid. When all models have the same outputs (the same classes, in the
+    same order, for classifiers), differences holds one more for each model
+    but the first, with the partial dependence of that model minus the one
+    of the first model (and, with bootstrap, the confidence
+    bands of that difference, as the same resamples are used for all
+    models). names (by default, 'Model 0', 'Model 1', ...) labels the models,
+    and difference_names the differences. All models are evaluated by the
+    brute method, so that they share the perturbed data.
+    """
+    def __init__(self, models, data, cat_features=[], real_features=[], names=None, **kwargs):
+        if any([isinstance(m, Async_Model) for m in models]):
+            raise NotImplementedError("Async_Model can not be used in a Model_Comparison")
+        self.names = list(names) if names is not None else [f'Model {i}' for i in range(len(models))]
+        if len(self.names) != len(models):
+            raise ValueError("There must be one name per model")
+        stacked = _Stacked_Models(models)
+        pdo = Partial_Dependence(stacked, data, cat_features, real_features, **kwargs)
+        self.peak_memory = pdo.peak_memory
+        self.results = list()
+        first = 0
+        for m, w in zip(models, stacked.widths):
+            self.results.append(pdo._select_outputs(range(first, first+w), _output_names(m, w)))
+            first += w
+        self.differences = list()
+        self.difference_names = list()
+        if stacked.comparable:
+            for m, name in zip(models[1:], self.names[1:]):
+                self.differences.append(pdo._select_outputs(range(first, first+stacked.widths[0]),
+                                                            self.results[0].outputs))
+                self.difference_names.append(f"{name} - {self.names[0]}")
+                first += stacked.widths[0]
+    def __getitem__(self, name):
+        # the result of a model or a difference, given by its name
+        if name in self.names:
+            return self.results[self.names.index(name)]
+        if name in self.difference_names:
+            return self.differences[self.difference_names.index(name)]
+        raise KeyError(f"Unknown model or difference: {name}")
+
+def _centered_pd(model, X, columns, feature_idx, max_memory=None):
+    # Partial dependence of each feature (a list of column indices) at the
+    # values it takes in the rows of X, which are also the background data.
+    # Repeated values (e.g. the levels of a one-hot group) are evaluated once.
+    blocks, inverses = [], []
+    for idx in feature_idx:
+        settings, inverse = np.unique(X[:,idx], axis=0, return_inverse=True)
+        blocks.append((idx, settings))
+        inverses.append(inverse.ravel())
+    o = []
+    for r, inverse in zip(_evaluate(model, X, columns, blocks, max_memory=max_memory), inverses):
+        v = r[inverse,0]
+        o.append(v - v.mean())
+    return o
+
+def interaction_strength(model, data, cat_features=[], real_features=[], n_rows=100, n_screen=25, keep=0.25, random_state=None, max_memory=None):
+    """
+    Rank pairs of features by Friedman's H-statistic.
+
+    H is the fraction of the variance of the two-dimensional partial dependence
+    of a pair which is not explained by the sum of the two one-dimensional
+    ones. It is estimated at n_rows rows sampled from data, which also serve as
+    background. Categorical features are given by the prefix of their one-hot
+    columns; if no features are given, all columns are screened. The
+    one-dimensional partial dependences are computed once per feature and
+    shared by all pairs, and the two-dimensional ones of many pairs are
+    predicted together. When n_screen < n_rows, all pairs are first screened
+    using only n_screen rows and just the best fraction keep of them is
+    re-evaluated with all n_rows. max_memory bounds the memory (in bytes)
+    taken by each evaluation of the model, as in Partial_Dependence.
+
+    Returns a pandas DataFrame with the columns 'Feature 1', 'Feature 2', 'H'
+    and 'Rows' (rows used in the estimate), sorted by decreasing H, with the
+    pairs estimated with all n_rows first.
+    """
+    X, columns = _background(data)
+    features = _screening_features(columns, X, cat_features, real_features)
+    if len(features) < 2:
+        raise ValueError("At least two features are needed to screen interactions")
+    rows = np.random.default_rng(random_state).permutation(len(X))[:n_rows]
+    stages = [len(rows)]
+    if n_screen < len(rows):
+        stages.insert(0, n_screen)
+    pairs = list(itertools.combinations(range(len(features)), 2))
+    h, used = {}, {}
+    for stage, m in enumerate(stages):
+        if stage > 0:
+            # prune: only the most promising pairs go on to the next stage
+            pairs = sorted(pairs, key=lambda p: h[p], reverse=True)
+            pairs = pairs[:max(1, int(np.ceil(keep*len(pairs))))]
+        S = X[rows[:m]]
+        needed = sorted(set([f for p in pairs for f in p]))
+        pd1 = dict(zip(needed, _centered_pd(model, S, columns, [features[f][1] for f in needed], max_memory)))
+        pd2 = _centered_pd(model, S, columns, [features[j][1]+features[k][1] for j,k in pairs], max_memory)
+        for (j,k), pjk in zip(pairs, pd2):
+            num = ((pjk - pd1[j] - pd1[k])**2).sum()
+            den = (pjk**2).sum()
+            h[(j,k)] = np.sqrt(num/den) if den > 0 else 0.0
+            used[(j,k)] = m
+    table = pd.DataFrame([[features[j][0], features[k][0], h[(j,k)], used[(j,k)]] for j,k in h],
+                         columns=['Feature 1', 'Feature 2', 'H', 'Rows'])
+    return table.sort_values(['Rows','H'], ascending=False, ignore_index=True)
+
+def feature_importance(model, data, cat_features=[], real_features=[], measure='variance', n_rows=None, min_rows=50, eta=2, keep=10, grid_resolution=20, random_state=None, max_memory=None):
+    """
+    Rank features by the strength of their one-dimensional partial dependence.
+
+    The importance of a feature is the variance (measure='variance') or the
+    range (measure='range') of its partial dependence over its grid, or over
+    the levels of a categorical feature. Categorical features are given by the
+    prefix of their one-hot columns; if no features are given, all columns are
+    ranked. All features are evaluated together, in batched model calls, by
+    successive halving: first using min_rows rows sampled from data as
+    background, then keeping only the best 1/eta of the features (but at least
+    keep of them) and multiplying the number of rows by eta, until n_rows rows
+    (by default, all of them) are used. max_memory bounds the memory (in
+    bytes) taken by each evaluation of the model, as in Partial_Dependence.
+
+    Returns a pandas DataFrame with the columns 'Feature', 'Importance' and
+    'Rows' (rows used in the estimate), sorted by decreasing importance, with
+    the features which stayed longer in contention first.
+    """
+    if measure not in ('variance', 'range'):
+        raise ValueError(f"Unknown importance measure: {measure}")
+    if not isinstance(eta, (int, np.integer)) or eta < 2:
+        raise ValueError(f"eta must be an integer greater than 1, not {eta}")
+    if not isinstance(min_rows, (int, np.integer)) or min_rows < 1:
+        raise ValueError(f"min_rows must be a positive integer, not {min_rows}")
+    if not isinstance(keep, (int, np.integer)) or keep < 1:
+        raise ValueError(f"keep must be a positive integer, not {keep}")
+    X, columns = _background(data)
+    features = _screening_features(columns, X, cat_features, real_features)
+    blocks = []
+    for name, idx, is_cat in features:
+        if is_cat:
+            blocks.append((idx, np.eye(len(idx))))
+        else:
+            blocks.append((idx, _grid(X[:,idx[0]], grid_resolution)[:,None]))
+    rows = np.random.default_rng(random_state).permutation(len(X))[:n_rows]
+    m = min(min_rows, len(rows))
+    candidates = list(range(len(features)))
+    importance, used = {}, {}
+    while True:
+        res = _evaluate(model, X[rows[:m]], columns, [blocks[f] for f in candidates], max_memory=max_memory)
+        for f, r in zip(candidates, res):
+            importance[f] = r[:,0].var() if measure=='variance' else np.ptp(r[:,0])
+            used[f] = m
+        if m == len(rows):
+            break
+        candidates = sorted(candidates, key=importance.get, reverse=True)
+        candidates = candidates[:max(keep, int(np.ceil(len(candidates)/eta)))]
+        m = min(len(rows), m*eta)
+    table = pd.DataFrame([[features[f][0], importance[f], used[f]] for f in importance],
+                         columns=['Feature', 'Importance', 'Rows'])
+    return table.sort_values(['Rows','Importance'], ascending=False, ignore_index=True)
+
+class _LRU_Cache():
+    # a thread-safe dictionary keeping only its maxsize most recently used items
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._items:
+                return default
+            self._items.move_to_end(key)
+            return self._items[key]
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+    def __len__(self):
+        return len(self._items)
+
+class PD_Server():
+    """
+    Answers partial dependence queries about one model and one data set,
+    which are loaded (and the data prepared) only once. Each query is a dict
+    with the lists cat_features and real_features, and optionally mode (which
+    is checked against the features), grid_resolution, bootstrap, ci and
+    method; the answer is the to_dict() of the corresponding
+    Partial_Dependence.
+
+    The last cache_size answers are kept, as are the evaluations of the last
+    cache_size*16 blocks of perturbations (e.g. the one-dimensional partial
+    dependence of a single feature), which are shared by overlapping
+    queries. Identical queries arriving while one is being computed wait for
+    its answer instead of repeating the computation. kwargs are passed on to
+    Partial_Dependence.
+    """
+    def __init__(self, model, data, cache_size=64, **kwargs):
+        self.model = model
+        self.kwargs = kwargs
+        self._prepared = _prepare_data(data, **kwargs)
+        self._answers = _LRU_Cache(cache_size)
+        self._evaluations = _LRU_Cache(cache_size*16)
+        self._running = dict()
+        self._lock = threading.Lock()
+    def columns(self):
+        return self._prepared[1]
+    def query(self, query):
+        if not isinstance(query, dict):
+            raise ValueError("A query must be a dict")
+        cat_features = query['cat_features'] if 'cat_features' in query else []
+        real_features = query['real_features'] if 'real_features' in query else []
+        self._check_features(cat_features, real_features)
+        options = dict(self.kwargs)
+        for k in ('grid_resolution', 'bootstrap', 'ci', 'method'):
+            if k in query:
+                options[k] = query[k]
+        if options.get('bootstrap') and 'random_state' not in options:
+            # answers must not depend on which query computed them first
+            options['random_state'] = 0
+        key = json.dumps([cat_features, real_features, sorted(options.items(), key=str)], default=str)
+        answer = self._answers.get(key)
+        if answer is not None:
+            return self._check_mode(answer, query)
+        with self._lock:
+            future = self._running.get(key)
+            owner = future is None
+            if owner:
+                future = self._running[key] = concurrent.futures.Future()
+        if not owner:
+            return self._check_mode(future.result(), query)
+        try:
+            pd_obj = Partial_Dependence(self.model, None, cat_features, real_features,
+                                        prepared=self._prepared, cache=self._evaluations, **options)
+            answer = pd_obj.to_dict()
+            self._answers[key] = answer
+            future.set_result(answer)
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._running[key]
+        return self._check_mode(answer, query)
+    def _check_features(self, cat_features, real_features):
+        # Raise ValueError unless every feature is found in the data: the
+        # categorical ones (and a single real one) as prefixes of columns,
+        # the other real ones as column names
+        columns = self.columns()
+        for features in (cat_features, real_features):
+            if not isinstance(features, list) or not all([isinstance(f, str) for f in features]):
+                raise ValueError("cat_features and real_features must be lists of names")
+        prefixes = cat_features + (real_features if len(real_features) == 1 else [])
+        names = real_features if len(real_features) > 1 else []
+        for f in prefixes:
+            if not _search_features(columns, f):
+                raise ValueError(f"No column of the data starts with {f}")
+        for f in names:
+            if f not in columns:
+                raise ValueError(f"No column of the data is named {f}")
+    def _check_mode(self, answer, query):
+        if 'mode' in query and query['mode'] != answer['mode']:
+            raise ValueError(f"The features given correspond to mode {answer['mode']}, not {query['mode']}")
+        # every caller gets its own copy, which it may change freely
+        return copy.deepcopy(answer)
+    def serve(self, host='127.0.0.1', port=8000):
+        # Serve over HTTP: POST a JSON query to get its answer; GET returns
+        # the names of the columns of the data. Blocks until interrupted.
+        server = http.server.ThreadingHTTPServer((host, port), _PD_Handler)
+        server.pd_server = self
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+
+class _PD_Handler(http.server.BaseHTTPRequestHandler):
+    def _reply(self, status, content):
+        body = json.dumps(content).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    def do_GET(self):
+        self._reply(200, self.server.pd_server.columns())
+    def do_POST(self):
+        try:
+            query = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            answer = self.server.pd_server.query(query)
+        except (KeyError, ValueError, TypeError, NotImplementedError) as e:
+            # a query which can not be answered
+            self._reply(400, {'error': str(e)})
+        except Exception as e:
+            self._reply(500, {'error': f"{type(e).__name__}: {e}"})
+        else:
+            self._reply(200, answer)
+
+usage = """Usage: cpd.py --serve MODEL DATA [--host HOST] [--port PORT] [--cache N]
+
+Serves partial dependence queries over HTTP (see cpd.PD_Server) about the
+pickled model MODEL, with the data in the csv (or parquet) file DATA, whose
+columns must be the inputs of the model."""
 
 def _main(**args):
-    pass
+    if 'serve' not in args:
+        return
+    model_fn, data_fn = args['serve']
+    with open(model_fn, 'rb') as f:
+        model = pickle.load(f)
+    data = pd.read_parquet(data_fn) if data_fn.endswith('.parquet') else pd.read_csv(data_fn)
+    server = PD_Server(model, data, cache_size=args['cache'] if 'cache' in args else 64)
+    server.serve(args['host'] if 'host' in args else '127.0.0.1', args['port'] if 'port' in args else 8000)
 
 if(__name__=='__main__'):
-    # this is a stub, but may be used someday
     import sys
     opts={}
     if(len(sys.argv)<2):
+        # the examples run this file (through exec) without arguments
         pass
-        #print("Usage: {} [--notes] [--help]".format(sys.argv[0]))
-        #sys.exit(0)
     n=1
     while(n<len(sys.argv)):
-        if(sys.argv[n]=='--notes'):
-            #print(notes)
-            #sys.exit(0)
-            pass
+        if(sys.argv[n]=='--serve' and n+2<len(sys.argv)):
+            opts['serve'] = sys.argv[n+1:n+3]
+            n += 2
+        elif(sys.argv[n] in ('--host','--port','--cache') and n+1<len(sys.argv)):
+            v = sys.argv[n+1]
+            opts[sys.argv[n][2:]] = v if sys.argv[n]=='--host' else int(v)
+            n += 1
         elif(sys.argv[n]=='--help'):
-            pass
-            #print(__doc__)
-            #sys.exit(0)
-        else: # This might be the input file
-            pass
-            #print("Unknown argument: {}".format(sys.argv[n]))
-            #sys.exit(1)
+            print(usage)
+            sys.exit(0)
+        else:
+            print("Unknown argument: {}".format(sys.argv[n]))
+            sys.exit(1)
         n += 1
     _main(**opts)
-        
-
-
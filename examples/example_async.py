@@ -0,0 +1,90 @@
+#! /usr/bin/env python3
+
+# MIT License
+#
+#Copyright 2020 Filipe Teixeira
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+
+import asyncio
+import json
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from urllib.request import urlopen, Request
+import numpy as np
+import pandas as pd
+from sklearn.model_selection import train_test_split
+from sklearn.ensemble import RandomForestRegressor
+
+# from cpd import Partial_Dependence, Async_Model
+# this is a workaround to avoid importing cpd
+exec(open('../cpd.py','r').read())
+
+data = pd.read_csv('compound_activity.csv')
+
+y = data['Activity'].to_numpy()
+X = pd.get_dummies(data.drop('Activity',axis=1))
+
+X_train, X_test, y_train, y_test = train_test_split(X, y, train_size=0.75)
+
+rf_model = RandomForestRegressor()
+
+rf_model.fit(X_train, y_train)
+
+# A local stand-in for a model server: it answers POST requests holding a
+# JSON list of rows with a JSON list of predictions
+
+class Handler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        rows = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        body = json.dumps(rf_model.predict(pd.DataFrame(rows, columns=X.columns)).tolist()).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    def log_message(self, *args):
+        pass
+
+server = HTTPServer(('127.0.0.1', 0), Handler)
+threading.Thread(target=server.serve_forever, daemon=True).start()
+url = f"http://127.0.0.1:{server.server_port}/"
+
+# The asynchronous predict function: any async HTTP client would do, here
+# the blocking urllib call is simply moved to a thread
+
+def post(batch):
+    req = Request(url, data=json.dumps(batch.to_numpy().tolist()).encode(),
+                  headers={'Content-Type': 'application/json'})
+    with urlopen(req) as r:
+        return json.loads(r.read())
+
+async def remote_predict(batch):
+    return await asyncio.to_thread(post, batch)
+
+remote_model = Async_Model(remote_predict, batch_size=2048, max_concurrency=4)
+
+pd_data = Partial_Dependence(remote_model, X_train, real_features=['Spec_265','Spec_266'],
+                             grid_resolution=20)
+
+pd_data.print_ascii(max_rows=20)
+
+server.shutdown()